@@ -0,0 +1,10 @@
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+
+from config import get_settings
+
+settings = get_settings()
+
+# async client for the request handlers and sync client for the report worker
+redis = AsyncRedis.from_url(settings.REDIS_URL)
+sync_redis = Redis.from_url(settings.REDIS_URL)
@@ -1,13 +1,41 @@
-from sqlalchemy import create_engine
+from psycopg2.extras import register_uuid
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from config import get_settings
 
 settings = get_settings()
 
-engine = create_engine(settings.SQLALCHEMY_DATABASE_URI)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# engine used by the request handlers, sized to serve concurrent requests. pre ping so that connections
+# dropped by the server are replaced transparently instead of failing the request. the handlers are async
+# so use the asyncpg driver to avoid blocking the event loop on queries.
+engine = create_async_engine(
+    make_url(settings.SQLALCHEMY_DATABASE_URI).set(drivername="postgresql+asyncpg"),
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=1800
+)
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+# shares the pool with engine, for single statement writes that don't need a transaction around them
+autocommit_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+
+# let psycopg2 pass report ids as UUIDs without casting them to strings first
+register_uuid()
+
+# separate small pool for long-running report generation so that an expensive report never starves the
+# request handlers of connections.
+background_engine = create_engine(
+    settings.SQLALCHEMY_DATABASE_URI,
+    pool_size=4,
+    max_overflow=0,
+    pool_pre_ping=True,
+    pool_recycle=1800
+)
 
 
 class Base(DeclarativeBase):
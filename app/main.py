@@ -1,36 +1,34 @@
-from io import StringIO
 from uuid import UUID
 
 from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
-from starlette.background import BackgroundTasks
-from starlette.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse, RedirectResponse
 
 from app import report
 from app.database import SessionLocal
 from app.schemas import TriggerReportResponse, RetrieveReportResponse
+from app.worker import run_report
 
 app = FastAPI()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 @app.get("/trigger_report", response_model=TriggerReportResponse)
-async def trigger_report(background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def trigger_report():
     """ Trigger a report generation """
-    report_id = report.create_entry(db)
-    background_tasks.add_task(report.run, report_id)
+    report_id = await report.create_entry()
+    # publishing to the broker is blocking, keep it off the event loop
+    await run_in_threadpool(run_report.delay, report_id)
     return TriggerReportResponse(report_id=report_id)
 
 
 @app.get("/get_report/{report_id}")
-async def retrieve_report(report_id: str, db: Session = Depends(get_db)):
+async def retrieve_report(report_id: str, db: AsyncSession = Depends(get_db)):
     """ Retrieve a given report """
     # report id's are UUIDs, validate id before passing to postgres to avoid errors
     try:
@@ -38,17 +36,19 @@ async def retrieve_report(report_id: str, db: Session = Depends(get_db)):
     except ValueError:
         raise HTTPException(status_code=400, detail=f"Report Id '{report_id}' is invalid")
 
-    status = report.check_status(db, report_id)
+    status = await report.check_status(db, report_id)
     if status is None:
         raise HTTPException(status_code=404, detail=f"Report '{report_id}' not found")
     elif status.value == "pending":
         return RetrieveReportResponse(status=status.value)
     else:
-        stream = StringIO()
-
-        df = report.retrieve(db, report_id)
-        df.to_csv(stream, index=False)
-
-        response = StreamingResponse(iter([stream.getvalue()]), media_type="text/csv")
-        response.headers["Content-Disposition"] = f"attachment; filename=report-{report_id}.csv"
-        return response
+        download_url = await report.get_download_url(db, report_id)
+        if download_url is not None:
+            return RedirectResponse(download_url, status_code=302)
+
+        # reports completed before csv uploads were added are streamed from postgres
+        return StreamingResponse(
+            report.retrieve(db, report_id),
+            media_type="text/csv",
+            headers={"Content-Disposition": f"attachment; filename=report-{report_id}.csv"}
+        )
@@ -3,7 +3,7 @@ from datetime import datetime, timedelta, time
 from typing import Optional
 from uuid import UUID
 
-from sqlalchemy import func, ForeignKey, Identity, text, BigInteger, Text, UniqueConstraint
+from sqlalchemy import func, ForeignKey, Identity, text, BigInteger, Text, Index, DateTime, DDL, event
 from sqlalchemy.orm import mapped_column, Mapped, relationship
 
 from app.database import Base
@@ -35,14 +35,77 @@ class StoreTimings(Base):
     start_time_local: Mapped[time]
     end_time_local: Mapped[time]
 
+    __table_args__ = (Index("ix_store_timing_store_id_day", "store_id", "day"),)
+
 
 class StoreObservation(Base):
     __tablename__ = "store_observation"
 
     id: Mapped[int] = mapped_column(BigInteger, Identity(), primary_key=True)
     store_id: Mapped[int] = mapped_column(BigInteger)
-    timestamp_utc: Mapped[datetime]
+    # the partition key needs to be part of the primary key
+    timestamp_utc: Mapped[datetime] = mapped_column(primary_key=True)
     status: Mapped[StoreStatus]
+    # maintained by the store_observation_localize trigger on insert
+    local_timestamp: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+    __table_args__ = (
+        Index("ix_store_observation_timestamp_utc_store_id", "timestamp_utc", "store_id"),
+        Index("ix_store_observation_local_timestamp", "local_timestamp"),
+        # partitioned by day so that reports only scan the partitions of the days in the report,
+        # see create_partitions in cli.py to create the partitions.
+        {"postgresql_partition_by": "RANGE (timestamp_utc)"},
+    )
+
+
+# catch observations for days which don't have a partition yet instead of failing the import, create_partitions
+# moves them into the day's partition once it is created.
+event.listen(StoreObservation.__table__, "after_create", DDL("""
+    CREATE TABLE store_observation_default PARTITION OF store_observation DEFAULT
+"""))
+
+
+# localize the timestamp once on insert instead of in every report, if the timezone is not specified,
+# assume America/Chicago. generated columns cannot refer to other tables, so use a trigger instead.
+event.listen(StoreObservation.__table__, "after_create", DDL("""
+    CREATE FUNCTION store_observation_localize() RETURNS trigger AS $$
+    BEGIN
+        NEW.local_timestamp := NEW.timestamp_utc AT TIME ZONE COALESCE(
+            (SELECT timezone_str FROM store WHERE id = NEW.store_id),
+            'America/Chicago'
+        );
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER store_observation_localize
+    BEFORE INSERT OR UPDATE OF store_id, timestamp_utc ON store_observation
+    FOR EACH ROW EXECUTE FUNCTION store_observation_localize();
+"""))
+
+# keep the localized timestamps in sync when a store's timezone changes or a store is added after its observations.
+# transition tables cannot be used with multiple events in one trigger, hence one trigger each for insert and update.
+event.listen(Store.__table__, "after_create", DDL("""
+    CREATE FUNCTION store_relocalize_observations() RETURNS trigger AS $$
+    BEGIN
+        UPDATE store_observation so
+           SET local_timestamp = so.timestamp_utc AT TIME ZONE COALESCE(s.timezone_str, 'America/Chicago')
+          FROM changed_store s
+         WHERE so.store_id = s.id;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER store_relocalize_observations_insert
+    AFTER INSERT ON store
+    REFERENCING NEW TABLE AS changed_store
+    FOR EACH STATEMENT EXECUTE FUNCTION store_relocalize_observations();
+
+    CREATE TRIGGER store_relocalize_observations_update
+    AFTER UPDATE ON store
+    REFERENCING NEW TABLE AS changed_store
+    FOR EACH STATEMENT EXECUTE FUNCTION store_relocalize_observations();
+"""))
 
 
 class Report(Base):
@@ -52,6 +115,8 @@ class Report(Base):
     status: Mapped[ReportStatus]
     started: Mapped[datetime] = mapped_column(server_default=func.now())
     completed: Mapped[Optional[datetime]]
+    # key of the uploaded report csv in the reports bucket
+    csv_key: Mapped[Optional[str]] = mapped_column(Text)
     items: Mapped[list["ReportItem"]] = relationship("ReportItem", back_populates="report")
 
 
@@ -70,5 +135,21 @@ class ReportItem(Base):
 
     report: Mapped[Report] = relationship("Report", back_populates="items")
 
-    __table_args__ = (UniqueConstraint(report_id, store_id),)
+    # include all the report columns in the unique index so that the report can be retrieved with an index only scan
+    __table_args__ = (
+        Index(
+            "ix_report_item_report_id_store_id",
+            report_id,
+            store_id,
+            unique=True,
+            postgresql_include=[
+                "uptime_last_hour",
+                "uptime_last_day",
+                "uptime_last_week",
+                "downtime_last_hour",
+                "downtime_last_day",
+                "downtime_last_week"
+            ]
+        ),
+    )
 
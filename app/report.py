@@ -1,70 +1,159 @@
+import asyncio
 import logging
-from typing import Optional
+from tempfile import SpooledTemporaryFile
+from typing import Optional, AsyncIterator
 from uuid import UUID
 
-import pandas as pd
-from pandas import DataFrame
-from sqlalchemy import text
-from sqlalchemy.orm import Session
+from psycopg2.sql import SQL, Literal
+from sqlalchemy import text, select, insert, Connection
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app import uptime
-from app.database import engine
+from app import storage, uptime
+from app.cache import redis, sync_redis
+from app.database import autocommit_engine, background_engine
 from app.models import Report, ReportStatus
 
+# the csv of a report, the report id placeholder is formatted as per the driver running it
+REPORT_CSV_QUERY = """
+    SELECT store_id
+         , EXTRACT(EPOCH FROM uptime_last_hour)::INT / 60 AS "uptime_last_hour(in hours)"
+         , EXTRACT(EPOCH FROM uptime_last_day)::INT / 3600 AS "uptime_last_day(in hours)"
+         , EXTRACT(EPOCH FROM uptime_last_week)::INT / 3600 AS "uptime_last_week(in hours)"
+         , EXTRACT(EPOCH FROM downtime_last_hour)::INT / 60 AS "downtime_last_hour(in minutes)"
+         , EXTRACT(EPOCH FROM downtime_last_day)::INT / 3600 AS "downtime_last_day(in hours)"
+         , EXTRACT(EPOCH FROM downtime_last_week)::INT / 3600 AS "downtime_last_week(in hours)"
+      FROM report_item
+     WHERE report_id = {report_id}
+"""
 
-def create_entry(db: Session) -> str:
+# clients poll the status of the report, cache it briefly to avoid hitting postgres on every poll
+STATUS_CACHE_TTL = 5
+
+
+def status_cache_key(report_id: UUID) -> str:
+    """ The redis key to cache the status of the given report at """
+    return f"report:{report_id}:status"
+
+
+async def create_entry() -> UUID:
     """ Create a new report entry in the database """
-    report = Report(status=ReportStatus.pending)
-    db.add(report)
-    db.commit()
-    db.refresh(report)
-    return str(report.id)
+    async with autocommit_engine.connect() as conn:
+        result = await conn.execute(insert(Report).values(status=ReportStatus.pending).returning(Report.id))
+        return result.scalar_one()
 
 
-def check_status(db: Session, report_id: UUID) -> Optional[ReportStatus]:
+async def check_status(db: AsyncSession, report_id: UUID) -> Optional[ReportStatus]:
     """ Check the current status of the report with the given report_id. """
-    report = db.query(Report).filter(Report.id == report_id).first()
-    return report.status if report else None
+    key = status_cache_key(report_id)
+    cached = await redis.get(key)
+    if cached is not None:
+        return ReportStatus(cached.decode())
+
+    result = await db.execute(select(Report.status).where(Report.id == report_id))
+    status = result.scalar_one_or_none()
+    if status is not None:
+        await redis.set(key, status.value, ex=STATUS_CACHE_TTL)
+    return status
+
+
+def upload_csv(conn: Connection, report_id: UUID) -> str:
+    """ Upload the csv of the computed report to object storage once so that downloads don't query postgres. """
+    key = f"reports/report-{report_id}.csv"
+    query = SQL("COPY ({query}) TO STDOUT WITH CSV HEADER").format(
+        query=SQL(REPORT_CSV_QUERY).format(report_id=Literal(report_id))
+    )
+    # spill large reports to disk instead of holding them in memory
+    with SpooledTemporaryFile(max_size=16 * 1024 * 1024) as f:
+        with conn.connection.cursor() as cursor:
+            cursor.copy_expert(query, f)
+        f.seek(0)
+        storage.upload(f, key)
+    return key
 
 
 def run(report_id: UUID):
     """ Run the uptime computation report. """
-    conn = engine.connect()
+    conn = background_engine.connect()
     try:
+        # give the window function sorts of the report enough memory to avoid spilling to disk and don't let a
+        # statement timeout configured for the role abort the report. the report can be recomputed if the commit
+        # is lost so don't wait for it to be flushed to disk.
+        conn.execute(text("SET LOCAL work_mem = '256MB'"))
+        conn.execute(text("SET LOCAL statement_timeout = 0"))
+        conn.execute(text("SET LOCAL synchronous_commit = off"))
+
+        # lock the report for the duration of the run so that other workers skip it if it is enqueued twice
+        claimed = conn.execute(text("""
+            SELECT id
+              FROM report
+             WHERE id = :report_id
+               AND status = 'pending'
+               FOR UPDATE SKIP LOCKED
+        """), {"report_id": report_id}).first()
+        if claimed is None:
+            return
+
         reference_ts = uptime.get_max_timestamp(conn)
         uptime.compute(conn, report_id, reference_ts)
+        csv_key = upload_csv(conn, report_id)
 
         conn.execute(text("""
             UPDATE report
                SET status = 'completed'
                  , completed = clock_timestamp()
+                 , csv_key = :csv_key
              WHERE id = :report_id
-        """), {"report_id": report_id})
+        """), {"report_id": report_id, "csv_key": csv_key})
     except Exception as e:
         logging.exception(e, exc_info=True)
         conn.rollback()
     else:
         conn.commit()
+        # the report is completed, drop the cached pending status so that clients see it immediately. the report
+        # has completed regardless, the cached status expires by itself if this fails.
+        try:
+            sync_redis.delete(status_cache_key(report_id))
+        except Exception as e:
+            logging.exception(e, exc_info=True)
     finally:
         conn.close()
 
 
-def retrieve(db: Session, report_id: UUID) -> DataFrame:
-    """ Retrieve the given report from the database """
-    return pd\
-        .read_sql_query(
-            text("""
-                SELECT store_id
-                     , EXTRACT(EPOCH FROM uptime_last_hour)::INT / 60 AS "uptime_last_hour(in hours)"
-                     , EXTRACT(EPOCH FROM uptime_last_day)::INT / 3600 AS "uptime_last_day(in hours)"
-                     , EXTRACT(EPOCH FROM uptime_last_week)::INT / 3600 AS "uptime_last_week(in hours)"
-                     , EXTRACT(EPOCH FROM downtime_last_hour)::INT / 60 AS "downtime_last_hour(in minutes)"
-                     , EXTRACT(EPOCH FROM downtime_last_day)::INT / 3600 AS "downtime_last_day(in hours)"
-                     , EXTRACT(EPOCH FROM downtime_last_week)::INT / 3600 AS "downtime_last_week(in hours)"
-                  FROM report_item
-                 WHERE report_id = :report_id
-            """),
-            db.connection(),
-            params={"report_id": str(report_id)}
-        )\
-        .astype("Int64")
+async def get_download_url(db: AsyncSession, report_id: UUID) -> Optional[str]:
+    """ Get a pre-signed url to download the csv of the given report, if it has been uploaded. """
+    result = await db.execute(select(Report.csv_key).where(Report.id == report_id))
+    csv_key = result.scalar_one_or_none()
+    return storage.download_url(csv_key, f"report-{report_id}.csv") if csv_key else None
+
+
+async def retrieve(db: AsyncSession, report_id: UUID) -> AsyncIterator[bytes]:
+    """ Stream the csv for the given report from the database """
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    driver_connection = raw_connection.driver_connection
+
+    # asyncpg writes the COPY output to a callback, hand the chunks over to the response through a bounded
+    # queue so that at most a few chunks are held in memory at a time.
+    chunks = asyncio.Queue(maxsize=16)
+
+    async def copy():
+        try:
+            await driver_connection.copy_from_query(
+                REPORT_CSV_QUERY.format(report_id="$1"),
+                report_id,
+                output=chunks.put,
+                format="csv",
+                header=True
+            )
+        finally:
+            await chunks.put(None)
+
+    task = asyncio.create_task(copy())
+    try:
+        while (chunk := await chunks.get()) is not None:
+            # asyncpg hands over bytearrays but starlette only passes bytes through as is
+            yield bytes(chunk)
+        # raise any error that occurred during the copy
+        await task
+    finally:
+        task.cancel()
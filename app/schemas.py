@@ -1,8 +1,10 @@
+from uuid import UUID
+
 from pydantic import BaseModel
 
 
 class TriggerReportResponse(BaseModel):
-    report_id: str
+    report_id: UUID
 
 
 class RetrieveReportResponse(BaseModel):
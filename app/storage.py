@@ -0,0 +1,29 @@
+import boto3
+
+from config import get_settings
+
+settings = get_settings()
+
+# credentials are picked up from the standard AWS environment variables or config files
+s3 = boto3.client("s3", endpoint_url=settings.S3_ENDPOINT_URL)
+
+# how long the download urls handed out to clients stay valid, in seconds
+DOWNLOAD_URL_EXPIRY = 3600
+
+
+def upload(fileobj, key: str):
+    """ Upload the file to the given key in the reports bucket """
+    s3.upload_fileobj(fileobj, settings.S3_BUCKET, key)
+
+
+def download_url(key: str, filename: str) -> str:
+    """ Generate a pre-signed url to download the given key from the reports bucket as an attachment """
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={
+            "Bucket": settings.S3_BUCKET,
+            "Key": key,
+            "ResponseContentDisposition": f"attachment; filename={filename}"
+        },
+        ExpiresIn=DOWNLOAD_URL_EXPIRY
+    )
@@ -0,0 +1,16 @@
+from uuid import UUID
+
+from celery import Celery
+
+from app import report
+from config import get_settings
+
+settings = get_settings()
+
+celery = Celery("app.worker", broker=settings.REDIS_URL)
+
+
+@celery.task
+def run_report(report_id: UUID):
+    """ Run the uptime computation report for the given report id in the worker. """
+    report.run(report_id)
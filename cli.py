@@ -1,8 +1,98 @@
-import pandas as pd
+from datetime import datetime, timedelta
+from typing import Optional
+
 import typer
+from psycopg2.sql import SQL, Identifier, Literal
 
 cli = typer.Typer()
 
+# read the csv files in large chunks while streaming them to COPY, psycopg2 reads 8kB at a time by default
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def copy_csv(cursor, table: str, path: str, renames: Optional[dict[str, str]] = None):
+    """
+    Bulk load a csv file into the given table using COPY.
+
+    :param cursor: psycopg2 cursor to execute the COPY on
+    :param table: name of the table to load the data into
+    :param path: path to the csv file, the header of the file is used to determine the columns
+    :param renames: mapping of csv header names to column names where they differ
+    """
+    renames = renames or {}
+    with open(path, "rb") as f:
+        header = f.readline().decode().strip()
+        columns = [renames.get(column, column) for column in header.split(",")]
+        query = SQL("COPY {table} ({columns}) FROM STDIN WITH CSV").format(
+            table=Identifier(table),
+            columns=SQL(", ").join(map(Identifier, columns))
+        )
+        cursor.copy_expert(query, f, size=COPY_BUFFER_SIZE)
+
+
+def create_tables():
+    """ Create the missing tables in the database. """
+    from app.database import Base, background_engine
+    from app import models  # noqa: F401, register the tables on the metadata
+
+    Base.metadata.create_all(background_engine)
+
+
+@cli.command(name="create-partitions")
+def create_partitions(start: Optional[datetime] = None, days: int = 7):
+    """
+    Create the daily partitions of store observations, this is meant to be run daily from a cron job to create
+    the partitions for the upcoming days ahead of time.
+
+    Observations imported for a day before its partition was created are in the default partition, they are moved
+    to the day's partition when it is created.
+
+    :param start: the first day to create a partition for, defaults to today in UTC
+    :param days: the number of daily partitions to create
+    """
+    create_tables()
+
+    from app.database import background_engine
+
+    # the partition key is in UTC
+    start_day = start.date() if start else datetime.utcnow().date()
+    conn = background_engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            for offset in range(days):
+                day = start_day + timedelta(days=offset)
+                partition = f"store_observation_{day:%Y%m%d}"
+
+                cursor.execute("SELECT to_regclass(%s)", (partition,))
+                if cursor.fetchone()[0] is not None:
+                    continue
+
+                # a partition overlapping rows in the default partition cannot be created, so create the table
+                # separately, move the day's rows into it and then attach it.
+                cursor.execute(SQL("""
+                    CREATE TABLE {partition} (LIKE store_observation INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+
+                    WITH moved AS (
+                        DELETE FROM store_observation_default
+                         WHERE timestamp_utc >= {start}
+                           AND timestamp_utc < {end}
+                     RETURNING *
+                    ) INSERT INTO {partition}
+                      SELECT *
+                        FROM moved;
+
+                    ALTER TABLE store_observation
+                    ATTACH PARTITION {partition}
+                    FOR VALUES FROM ({start}) TO ({end});
+                """).format(
+                    partition=Identifier(partition),
+                    start=Literal(day),
+                    end=Literal(day + timedelta(days=1))
+                ))
+        conn.commit()
+    finally:
+        conn.close()
+
 
 @cli.command(name="import")
 def import_(store_timezone_path: str, store_timings_path: str, store_observations_path: str):
@@ -13,17 +103,21 @@ def import_(store_timezone_path: str, store_timings_path: str, store_observation
     :param store_timings_path: path to the csv file containing information about the store's business hours
     :param store_observations_path: path to the csv file containing information about the store's status
     """
-    store_timezone_df = pd.read_csv(store_timezone_path)
-    store_timings_df = pd.read_csv(store_timings_path)
-    store_observations_df = pd.read_csv(store_observations_path)
+    # COPY does not create missing tables
+    create_tables()
 
-    store_timezone_df = store_timezone_df.rename(columns={"store_id": "id"})
+    from app.database import background_engine
 
-    from app.database import engine
-    with engine.connect() as conn:
-        store_timezone_df.to_sql("store", con=conn, index=False, if_exists="append")
-        store_timings_df.to_sql("store_timing", con=conn, index=False, if_exists="append")
-        store_observations_df.to_sql("store_observation", con=conn, index=False, if_exists="append")
+    conn = background_engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            # stores are imported first so that the observations are localized with the store's timezone
+            copy_csv(cursor, "store", store_timezone_path, {"store_id": "id"})
+            copy_csv(cursor, "store_timing", store_timings_path)
+            copy_csv(cursor, "store_observation", store_observations_path)
+        conn.commit()
+    finally:
+        conn.close()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,15 @@
 from functools import lru_cache
+from typing import Optional
 
 from pydantic import BaseSettings
 
 
 class Settings(BaseSettings):
     SQLALCHEMY_DATABASE_URI: str
+    REDIS_URL: str = "redis://localhost:6379/0"
+    S3_BUCKET: str = "store-monitoring-reports"
+    # set to use an S3 compatible store like MinIO instead of AWS
+    S3_ENDPOINT_URL: Optional[str] = None
 
     class Config:
         env_file = ".env"